@@ -15,40 +15,130 @@
 # limitations under the License.
 
 
-from os import getenv
-from io import BytesIO
-from json import loads, dumps
-from hashlib import md5
-from datetime import datetime
-from datetime import timezone
-from operator import attrgetter
+from os import getenv, path
+from json import loads as json_loads, dumps as json_dumps
+from pickle import Pickler, dumps as pickle_dumps, loads as pickle_loads
+from hashlib import blake2b
+from gzip import compress as gzip_compress, decompress as gzip_decompress
+from heapq import heapify, heappush, heappop
+from weakref import finalize
 from functools import update_wrapper
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock, RLock
+from io import BytesIO
+from time import monotonic, time
 
 from boto3 import resource
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
+try:
+    import orjson # optional. serializer='orjson'
+except ImportError:
+    orjson = None
 
-def s3_fifo_cache(maxsize=128, typed=False, bucket_name=None):
-    return _s3_cache(maxsize, typed, bucket_name, False)
+try:
+    import msgpack # optional. serializer='msgpack'
+except ImportError:
+    msgpack = None
 
-def s3_lru_cache(maxsize=128, typed=False, bucket_name=None):
-    return _s3_cache(maxsize, typed, bucket_name, True)
+try:
+    import zstandard # optional. compression='zstd'
+except ImportError:
+    zstandard = None
 
+try:
+    import diskcache # optional. local_cache_dir
+except ImportError:
+    diskcache = None
 
-# See https://github.com/python/cpython/blob/master/Lib/functools.py#L430
-_CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+def _json_dumps(value):
+    """Serialize value to UTF-8 JSON bytes"""
+    return json_dumps(value).encode(encoding='utf-8')
+
+
+def _json_loads(data):
+    """Deserialize UTF-8 JSON bytes"""
+    return json_loads(data)
+
+
+def _orjson_dumps(value):
+    return orjson.dumps(value)
+
+
+def _orjson_loads(data):
+    return orjson.loads(data)
+
+
+def _msgpack_dumps(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def _pickle_dumps(value):
+    return pickle_dumps(value, protocol=4)
 
 
-class _HashedSeq(list):
-    """See https://github.com/python/cpython/blob/master/Lib/functools.py#L432"""
-    __slots__ = 'hashvalue'
+# serializer name -> (dumps, loads). the name is stored in object metadata, and objects of other formats are ignored.
+# note that 'pickle' can execute arbitrary code on loads. use it only with a trusted bucket.
+_SERIALIZERS = {
+    'json': (_json_dumps, _json_loads),
+    'orjson': (_orjson_dumps, _orjson_loads), # faster, but NaN and Infinity become null. it accepts e.g. UUID, Enum and datetime, and rejects non-str keys
+    'msgpack': (_msgpack_dumps, _msgpack_loads),
+    'pickle': (_pickle_dumps, pickle_loads),
+}
 
-    def __init__(self, tup, hash=hash):
-        self[:] = tup
-        self.hashvalue = hash(tup)
 
-    def __hash__(self):
-        return self.hashvalue
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor(level=3).compress(data) # not thread safe. do not share it
+
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _gzip_compress(data):
+    return gzip_compress(data, compresslevel=6) # default 9 is too slow for little gain
+
+
+# compression name -> (compress, decompress). the name is stored as 'Content-Encoding' of the object.
+_COMPRESSIONS = {
+    'gzip': (_gzip_compress, gzip_decompress),
+    'zstd': (_zstd_compress, _zstd_decompress),
+}
+
+
+def s3_fifo_cache(maxsize=128, typed=False, bucket_name=None, key_hasher=None, serializer='json', compression=None, local_cache_dir=None, mem_maxsize=128,
+                  local_cache_size=2**30, local_cache_expire=86400, refresh_interval=60):
+    return _s3_cache(maxsize, typed, bucket_name, False, key_hasher, serializer=serializer, compression=compression, local_cache_dir=local_cache_dir, mem_maxsize=mem_maxsize,
+                     local_cache_size=local_cache_size, local_cache_expire=local_cache_expire, refresh_interval=refresh_interval)
+
+def s3_lru_cache(maxsize=128, typed=False, bucket_name=None, key_hasher=None, serializer='json', compression=None, local_cache_dir=None, mem_maxsize=128, touch_interval=60,
+                 local_cache_size=2**30, local_cache_expire=86400, refresh_interval=60):
+    return _s3_cache(maxsize, typed, bucket_name, True, key_hasher, serializer=serializer, compression=compression, local_cache_dir=local_cache_dir, mem_maxsize=mem_maxsize, touch_interval=touch_interval,
+                     local_cache_size=local_cache_size, local_cache_expire=local_cache_expire, refresh_interval=refresh_interval)
+
+
+# large objects are transferred in parts by parallel requests, since a single stream is limited to tens of MB/s
+_CHUNK_SIZE = 8 * 1024 * 1024
+_MAX_CONCURRENCY = 8 # parts of large objects in flight at once. shared by all downloads and uploads of a cache
+_MAX_WORKERS = 16 # keys in flight at once for get_many and set_many. with parts, it stays within max_pool_connections
+
+# the default pool (10 connections) is too small for parallel requests ("Connection pool is full" warning)
+# https://botocore.amazonaws.com/v1/documentation/api/latest/reference/config.html
+_BOTO_CONFIG = Config(max_pool_connections=50,
+                      retries={'mode': 'adaptive', 'max_attempts': 10},
+                      tcp_keepalive=True) # addressing style is left to botocore (path style for dotted bucket names and custom endpoints)
+
+
+# See https://github.com/python/cpython/blob/master/Lib/functools.py#L430
+_CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
 
 
 def _make_key(args, kwds, typed,
@@ -67,15 +157,34 @@ def _make_key(args, kwds, typed,
             key += tuple(type(v) for v in kwds.values())
     elif len(key) == 1 and type(key[0]) in fasttypes:
         return key[0]
-    return _HashedSeq(key)
+    return key # a plain tuple. it is only passed to str(), never hashed as a dict key
 
 
-def _s3_cache(maxsize, typed, bucket_name, is_lru):
+def _encode_call(args, kwds, typed, protocol=4):
+    """Encode arguments of a call into bytes to be hashed"""
+    try:
+        with BytesIO() as f:
+            pickler = Pickler(f, protocol=protocol)
+            # no memo. otherwise equal arguments get different keys by identity, e.g. f(s, s) and f(s, ''.join(...))
+            pickler.fast = True # raises on cyclic objects, which fall back to str() below
+            # sort kwds so that f(a=1, b=2) and f(b=2, a=1) share the same key
+            pickler.dump((args, sorted(kwds.items()) if kwds else (), typed))
+            return f.getvalue()
+    except Exception:
+        return str(_make_key(args, kwds, typed, kwd_mark = ('kwd_mark',))).encode() # unpicklable (e.g. lambda, local class)
+
+
+def _blake2b_hexdigest(data):
+    """Default key_hasher. It must return a string which is safe for S3 object key"""
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+def _s3_cache(maxsize, typed, bucket_name, is_lru, key_hasher, **kwds):
     """See https://github.com/python/cpython/blob/master/Lib/functools.py#L479"""
     if callable(maxsize) and isinstance(typed, bool):
         # The user_function was passed in directly via the maxsize argument
         user_function, maxsize = maxsize, 128
-        wrapper = _s3_cache_wrapper(user_function, maxsize, typed, _CacheInfo, bucket_name, is_lru)
+        wrapper = _s3_cache_wrapper(user_function, maxsize, typed, _CacheInfo, bucket_name, is_lru, key_hasher, **kwds)
         wrapper.cache_parameters = lambda : {'maxsize': maxsize, 'typed': typed}
         return update_wrapper(wrapper, user_function)
     elif maxsize is None or (isinstance(maxsize, int) and maxsize > 0):
@@ -84,37 +193,53 @@ def _s3_cache(maxsize, typed, bucket_name, is_lru):
         raise TypeError('Expected first argument to be a non-zero positive integer, a callable or None')
 
     def decorating_function(user_function):
-        wrapper = _s3_cache_wrapper(user_function, maxsize, typed, _CacheInfo, bucket_name, is_lru)
+        wrapper = _s3_cache_wrapper(user_function, maxsize, typed, _CacheInfo, bucket_name, is_lru, key_hasher, **kwds)
         wrapper.cache_parameters = lambda : {'maxsize': maxsize, 'typed': typed}
         return update_wrapper(wrapper, user_function)
 
     return decorating_function
 
 
-def _s3_cache_wrapper(user_function, maxsize, typed, _CacheInfo, bucket_name, is_lru):
+def _s3_cache_wrapper(user_function, maxsize, typed, _CacheInfo, bucket_name, is_lru, key_hasher, **kwds):
     """See https://github.com/python/cpython/blob/master/Lib/functools.py#L525"""
     sentinel = object()
-    make_key = _make_key
+    encode_call = _encode_call
+    if key_hasher is None:
+        key_hasher = _blake2b_hexdigest
     # cache = {}
-    cache = _S3Dict(bucket_name, is_lru=is_lru)
+    cache = _S3Dict(bucket_name, is_lru=is_lru, **kwds)
     hits = misses = 0
-    cache_get = cache.get
+    cache_get = cache.get # bound methods are looked up once here, not on every call
     cache_len = cache.__len__
-    if maxsize is None or (isinstance(maxsize, int) and maxsize > 0):
+    cache_setitem = cache.__setitem__
+    cache_popitem = cache.popitem
+    if maxsize is None:
+        def wrapper(*args, **kwds):
+            # Simple caching without ordering or size limit
+            nonlocal hits, misses
+            key = key_hasher(encode_call(args, kwds, typed))
+            result = cache_get(key, sentinel)
+            if result is not sentinel:
+                hits += 1
+                return result
+            misses += 1
+            result = user_function(*args, **kwds)
+            cache_setitem(key, result)
+            return result
+    elif isinstance(maxsize, int) and maxsize > 0:
         def wrapper(*args, **kwds):
             # Size limited caching that tracks accesses by recency
             nonlocal hits, misses
-            k = make_key(args, kwds, typed, kwd_mark = ('kwd_mark',))
-            key = md5(str(k).encode()).hexdigest()
+            key = key_hasher(encode_call(args, kwds, typed))
             result = cache_get(key, sentinel)
             if result is not sentinel:
                 hits += 1
                 return result
             misses += 1
             result = user_function(*args, **kwds)
-            if isinstance(maxsize, int) and cache_len() >= maxsize:
-                cache.popitem(last=False) # delete oldest item (FIFO)
-            cache[key] = result
+            if cache_len() >= maxsize:
+                cache_popitem(last=False) # delete oldest item (FIFO)
+            cache_setitem(key, result)
             return result
     else:
         raise TypeError('Expected maxsize argument to be a non-zero positive integer or None')
@@ -133,58 +258,431 @@ def _s3_cache_wrapper(user_function, maxsize, typed, _CacheInfo, bucket_name, is
         """Set cache expiration days"""
         cache.set_expiration(days)
 
+    def cache_flush():
+        """Delete evicted objects which are pending for batched deletion"""
+        cache.flush()
+
+    def cache_get_many(args_list, default=None):
+        """Look up cached results of many calls (tuples of positional arguments) by parallel requests.
+        It does not call the function nor update statistics"""
+        keys = [key_hasher(encode_call(tuple(args), {}, typed)) for args in args_list]
+        found = cache.get_many(keys)
+        return [found.get(key, default) for key in keys]
+
     wrapper.cache_info = cache_info
     wrapper.cache_clear = cache_clear
     wrapper.cache_set_expiration = cache_set_expiration
+    wrapper.cache_flush = cache_flush
+    wrapper.cache_get_many = cache_get_many
     return wrapper
 
 
+_MISSING = object()
+
+
+def _flush(s3_bucket, pending):
+    # delete popped objects by a single DeleteObjects request instead of one request per object
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Bucket.delete_objects
+    while pending:
+        keys = list(pending)[:1000]
+        s3_bucket.delete_objects(Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+        for k in keys:
+            pending.pop(k, None)
+
+
+def _flush_quietly(s3_bucket, pending):
+    try:
+        _flush(s3_bucket, pending)
+    except Exception:
+        pass # at exit. objects are left in the bucket and evicted again later
+
+
+def _is_not_found(e):
+    return e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey')
+
+
 class _S3Dict: # class _S3Dict(dict): # TODO: implement dict (or OrderedDict) interface properly
-    def __init__(self, bucket_name, is_lru=False):
-        self.s3_bucket = resource('s3').Bucket(bucket_name) # s3.resource
+    def __init__(self, bucket_name, is_lru=False, mem_maxsize=128, serializer='json', compression=None, local_cache_dir=None, touch_interval=60, delete_batch_size=64,
+                 negative_ttl=60, negative_maxsize=1024, local_cache_size=2**30, local_cache_expire=86400, refresh_interval=60):
+        if serializer not in _SERIALIZERS:
+            raise TypeError(f'Expected serializer argument to be one of {", ".join(_SERIALIZERS)}')
+        if serializer == 'orjson' and orjson is None:
+            raise ImportError('serializer="orjson" requires orjson package')
+        if serializer == 'msgpack' and msgpack is None:
+            raise ImportError('serializer="msgpack" requires msgpack package')
+        if compression is not None and compression not in _COMPRESSIONS:
+            raise TypeError(f'Expected compression argument to be one of {", ".join(_COMPRESSIONS)} or None')
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError('compression="zstd" requires zstandard package')
+        if local_cache_dir is not None and diskcache is None:
+            raise ImportError('local_cache_dir requires diskcache package')
+        if not (isinstance(mem_maxsize, int) and mem_maxsize > 0):
+            raise TypeError('Expected mem_maxsize argument to be a non-zero positive integer')
+        self.s3_bucket = resource('s3', config=_BOTO_CONFIG).Bucket(bucket_name) # s3.resource of the default session
+        self.serializer = serializer
+        self.compression = compression # None means no compression
+        self._transfer_config = TransferConfig(multipart_threshold=_CHUNK_SIZE, multipart_chunksize=_CHUNK_SIZE, max_concurrency=_MAX_CONCURRENCY, use_threads=True)
         self.is_lru = is_lru # FIFO or LRU
+        self.mem_maxsize = mem_maxsize # max items in the in-process cache. independent of maxsize of S3, which may hold more than memory
+        self.touch_interval = touch_interval # min seconds between 'touch'es of the same key (LRU only)
+        self._mem = OrderedDict() # in-process cache in front of S3 to avoid redundant downloads
+        # local disk cache between _mem and S3. it survives restarts. one directory per bucket so that caches do not see (or clear) others' entries.
+        # it does not know evictions by other processes, so entries expire after local_cache_expire seconds (None means never)
+        self._disk = None if local_cache_dir is None else diskcache.Cache(path.join(local_cache_dir, bucket_name), size_limit=local_cache_size)
+        self.local_cache_expire = local_cache_expire
+        self._touched = {} # key -> monotonic() of the last 'touch'
+        self._mtime = None # key -> 'last_modified' (UNIX time) of every object. loaded lazily by a single LIST
+        self._heap = None # (last_modified, key) to find the oldest object without LIST. may contain stale entries
+        self.refresh_interval = refresh_interval # seconds between LISTs to notice objects added or deleted by other processes. None means only when empty
+        self._loaded = None # monotonic() of the last LIST
+        self._lock = RLock() # guards the index (_mtime and _heap) and _pending against concurrent callers
+        self.delete_batch_size = delete_batch_size # popped keys are deleted together by a single request (max 1000)
+        self._pending = {} # popped keys which are not deleted yet. dict as ordered set
+        self._pool = None # ThreadPoolExecutor for get_many and set_many. created lazily
+        self._parts_pool = ThreadPoolExecutor(max_workers=_MAX_CONCURRENCY) # parts of large downloads. threads start on demand
+        self._multipart_lock = Lock() # one multipart upload (max_concurrency threads) at a time
+        self.negative_ttl = negative_ttl # seconds to remember keys which were not found
+        self.negative_maxsize = negative_maxsize
+        self._negative = OrderedDict() # key -> monotonic() when it expires. avoid repeated 404 requests
+        # delete pending keys at garbage collection or exit. do not refer self, otherwise it is never freed
+        finalize(self, _flush_quietly, self.s3_bucket, self._pending)
 
     def __getitem__(self, key):
-        with BytesIO() as f:
-            self.s3_bucket.download_fileobj(Key=key, Fileobj=f)
-            if self.is_lru:
-                # there is no 'touch' API. instead it needs to use 'copy' which updates 'last_modified' field.
-                # https://stackoverflow.com/a/39596988
-                # https://faragta.com/aws-s3/touch-command.html
-                metadata = self.s3_bucket.Object(key).metadata
-                self.s3_bucket.copy(CopySource={'Bucket': self.s3_bucket.name, 'Key': key}, Key=key, ExtraArgs={'Metadata': metadata, 'MetadataDirective': 'REPLACE'})
-            return loads(f.getvalue().decode(encoding='utf-8'))
+        if key in self._pending:
+            raise KeyError(key) # already popped
+        value = self._local(key)
+        if value is _MISSING:
+            value, last_modified = self._fetch(key)
+            self._fetched(key, value, last_modified)
+        if self.is_lru:
+            self._used(key)
+        return value
+
+    def _local(self, key):
+        # look up the in-process and local disk tiers. _MISSING if neither has it
+        try:
+            value = self._mem[key]
+        except KeyError:
+            value = _MISSING if self._disk is None else self._disk.get(key, _MISSING)
+            if value is not _MISSING:
+                self._remember(key, value)
+        else:
+            self._mem.move_to_end(key)
+        return value
+
+    def _fetch(self, key):
+        # only S3 requests here. it is called from worker threads by get_many
+        data, response = self._download(key)
+        # decode only the configured format. others are misses, so that e.g. a json cache never unpickles injected objects
+        if response['Metadata'].get('format', 'json') != self.serializer: # S3 returns metadata keys in lower case. no 'format' means json
+            raise KeyError(key)
+        loads = _SERIALIZERS[self.serializer][1]
+        if response.get('ContentEncoding') in _COMPRESSIONS: # no 'ContentEncoding' means not compressed
+            data = _COMPRESSIONS[response['ContentEncoding']][1](data)
+        return loads(data), response['LastModified']
+
+    def _fetched(self, key, value, last_modified):
+        self._remember(key, value)
+        if self._disk is not None:
+            self._disk.set(key, value, expire=self.local_cache_expire)
+        if self.is_lru and key not in self._touched:
+            # no need to 'touch' it until touch_interval passes since it was uploaded or touched by any process
+            age = time() - last_modified.timestamp()
+            self._touched[key] = monotonic() - max(age, 0)
+
+    def _used(self, key):
+        self._index(key, time()) # exact recency in this process without any request
+        self._touch(key)
+
+    def _download(self, key):
+        # the first range request gets the whole object if it is small enough. no need to HEAD
+        client, bucket_name = self.s3_bucket.meta.client, self.s3_bucket.name
+        response = client.get_object(Bucket=bucket_name, Key=key, Range=f'bytes=0-{_CHUNK_SIZE - 1}')
+        data = response['Body'].read() # StreamingBody. no need to copy into BytesIO
+        size = int(response['ContentRange'].rsplit('/', 1)[1]) if 'ContentRange' in response else len(data)
+        if size > len(data):
+            # get the rest by parallel range requests into a preallocated buffer
+            buf = bytearray(size)
+            buf[:len(data)] = data
+            def get_range(start):
+                end = min(start + _CHUNK_SIZE, size) - 1
+                part = client.get_object(Bucket=bucket_name, Key=key, Range=f'bytes={start}-{end}', IfMatch=response['ETag']) # fail if it is overwritten meanwhile
+                buf[start:end + 1] = part['Body'].read()
+            # a separate pool from get_many's one, otherwise its workers could wait for parts queued behind themselves
+            list(self._parts_pool.map(get_range, range(len(data), size, _CHUNK_SIZE))) # list() to raise exceptions
+            data = buf
+        return data, response
+
+    def _remember(self, key, value):
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        if len(self._mem) > self.mem_maxsize:
+            oldest, _ = self._mem.popitem(last=False)
+            self._touched.pop(oldest, None)
+
+    def _forget(self, key):
+        self._mem.pop(key, None)
+        self._touched.pop(key, None)
+        if self._disk is not None:
+            self._disk.delete(key)
+
+    def _touch(self, key):
+        # persist recency for other processes, which only see 'last_modified' by LIST.
+        # there is no 'touch' API. instead it needs to use 'copy' which updates 'last_modified' field.
+        # https://stackoverflow.com/a/39596988
+        # https://faragta.com/aws-s3/touch-command.html
+        # recency does not have to be exact, so skip it if the key has been touched recently.
+        if not self._needs_touch(key):
+            return
+        now = monotonic()
+        try:
+            self._copy(key)
+        except ClientError as e:
+            if _is_not_found(e):
+                self._vanished(key)
+            raise
+        self._touched[key] = now
+
+    def _needs_touch(self, key):
+        return key not in self._touched or monotonic() - self._touched[key] >= self.touch_interval
+
+    def _copy(self, key):
+        # only S3 requests here. it is called from worker threads by get_many
+        obj = self.s3_bucket.Object(key)
+        extra_args = {'Metadata': obj.metadata, 'MetadataDirective': 'REPLACE'}
+        if obj.content_encoding is not None:
+            extra_args['ContentEncoding'] = obj.content_encoding # 'REPLACE' drops it as well
+        self.s3_bucket.copy(CopySource={'Bucket': self.s3_bucket.name, 'Key': key}, Key=key, ExtraArgs=extra_args)
+
+    def _vanished(self, key):
+        # deleted (or expired) by others. S3 is the source of truth
+        with self._lock:
+            if self._mtime is not None:
+                self._mtime.pop(key, None)
+        self._forget(key)
+
+    def _load_index(self):
+        # build both in locals and publish them together, so that others never see a half loaded index
+        with self._lock:
+            mtime = {}
+            paginator = self.s3_bucket.meta.client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.s3_bucket.name, PaginationConfig={'PageSize': 1000}):
+                for obj in page.get('Contents', ()):
+                    if obj['Key'] not in self._pending: # popped but not deleted yet
+                        mtime[obj['Key']] = obj['LastModified'].timestamp()
+            if self._mtime is not None:
+                for key, t in self._mtime.items():
+                    if key in mtime and t > mtime[key]:
+                        mtime[key] = t # recency in this process which is not 'touch'ed to S3 yet
+            heap = [(t, k) for k, t in mtime.items()]
+            heapify(heap)
+            self._mtime, self._heap = mtime, heap
+            self._loaded = monotonic()
+
+    def _load_index_if_stale(self):
+        with self._lock:
+            if self._mtime is None or (self.refresh_interval is not None and monotonic() - self._loaded >= self.refresh_interval):
+                self._load_index()
+
+    def _index(self, key, last_modified):
+        with self._lock:
+            if self._mtime is None:
+                return # not loaded yet. it will be loaded by LIST when needed
+            self._mtime[key] = last_modified
+            heappush(self._heap, (last_modified, key))
+            if len(self._heap) > 2 * len(self._mtime) + 64: # too many stale entries
+                self._heap = [(t, k) for k, t in self._mtime.items()]
+                heapify(self._heap)
+
+    def _find_target(self, last):
+        if last:
+            return max(self._mtime, key=self._mtime.__getitem__, default=None) # in memory, no need to use heap
+        while self._heap:
+            t, key = heappop(self._heap)
+            if self._mtime.get(key) == t: # skip stale entries (overwritten, touched or deleted)
+                return key
+        return None
 
     def get(self, key, default=None):
+        if self._known_missing(key):
+            return default
         try:
             return self[key]
+        except ClientError as e:
+            if _is_not_found(e):
+                self._missing(key)
+            return default
         except Exception as e:
             # print(str(e))
             return default
 
+    def _known_missing(self, key):
+        expires = self._negative.get(key)
+        if expires is None:
+            return False
+        if monotonic() < expires:
+            return True
+        del self._negative[key]
+        return False
+
+    def _missing(self, key):
+        self._negative[key] = monotonic() + self.negative_ttl
+        self._negative.move_to_end(key)
+        if len(self._negative) > self.negative_maxsize:
+            self._negative.popitem(last=False)
+
     def __setitem__(self, key, value):
-        with BytesIO(dumps(value).encode(encoding='utf-8')) as f:
-            self.s3_bucket.upload_fileobj(Fileobj=f, Key=key, ExtraArgs={'Metadata': {'Created': datetime.now(timezone.utc).isoformat()}})
+        self._unpend(key)
+        self._stored(key, *self._upload(key, value))
+
+    def _unpend(self, key):
+        # do not delete it later. before uploading, otherwise a flush in another thread may delete the new object
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _upload(self, key, value):
+        # only S3 requests here. it is called from worker threads by set_many
+        # returns the decoded form of the uploaded data, so that every tier returns the same value as other processes get.
+        # (e.g. list instead of tuple for json) it does not share the caller's object either.
+        now = time()
+        dumps, loads = _SERIALIZERS[self.serializer]
+        data = dumps(value)
+        value = loads(data)
+        extra_args = {'Metadata': {'Created': format(now, '.6f'), 'Format': self.serializer}}
+        if self.compression is not None:
+            data = _COMPRESSIONS[self.compression][0](data)
+            extra_args['ContentEncoding'] = self.compression
+        client, bucket_name = self.s3_bucket.meta.client, self.s3_bucket.name
+        if len(data) < _CHUNK_SIZE:
+            client.put_object(Bucket=bucket_name, Key=key, Body=data, **extra_args)
+        else:
+            with BytesIO(data) as f, self._multipart_lock: # multipart upload by parallel requests
+                client.upload_fileobj(Fileobj=f, Bucket=bucket_name, Key=key, ExtraArgs=extra_args, Config=self._transfer_config)
+        return value, now
+
+    def _stored(self, key, value, now):
+        self._negative.pop(key, None)
+        self._index(key, now)
+        self._remember(key, value)
+        if self._disk is not None:
+            self._disk.set(key, value, expire=self.local_cache_expire) # write through
+        if self.is_lru:
+            self._touched[key] = monotonic() # upload updates 'last_modified' as well
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=_MAX_WORKERS)
+        return self._pool
+
+    def get_many(self, keys):
+        # download missing keys by parallel requests. bookkeeping stays in the calling thread (not thread safe)
+        # returns {key: value} of found keys
+        # like get(), a key is not found if any of its requests (including 'touch') fails
+        result, futures, touches, seen = {}, {}, {}, set()
+        for key in keys:
+            if key in self._pending or key in seen or self._known_missing(key):
+                continue
+            seen.add(key)
+            value = self._local(key)
+            if value is _MISSING:
+                futures[self._executor().submit(self._fetch, key)] = key
+            else:
+                result[key] = value
+                self._use_later(key, touches)
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                value, last_modified = future.result()
+            except ClientError as e:
+                if _is_not_found(e):
+                    self._missing(key)
+                continue
+            except Exception:
+                continue
+            self._fetched(key, value, last_modified)
+            result[key] = value
+            self._use_later(key, touches)
+        for future in as_completed(touches):
+            key, now = touches[future]
+            try:
+                future.result()
+            except ClientError as e:
+                if _is_not_found(e):
+                    self._vanished(key)
+                    self._missing(key)
+                del result[key]
+                continue
+            except Exception:
+                del result[key]
+                continue
+            self._touched[key] = now
+        return result
+
+    def _use_later(self, key, touches):
+        # same as _used but 'touch' by a worker thread
+        if not self.is_lru:
+            return
+        self._index(key, time())
+        if self._needs_touch(key):
+            touches[self._executor().submit(self._copy, key)] = (key, monotonic())
+
+    def set_many(self, items):
+        # upload items by parallel requests. bookkeeping stays in the calling thread (not thread safe)
+        items = dict(items)
+        for key in items:
+            self._unpend(key)
+        futures = {self._executor().submit(self._upload, key, value): key for key, value in items.items()}
+        error = None
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                error = error or e # keep the others' bookkeeping, then raise the first error
+                continue
+            self._stored(futures[future], *result)
+        if error is not None:
+            raise error
 
     def __len__(self):
-        # return len(list(self.s3_bucket.objects.all()))
-        # https://stackoverflow.com/a/32409177
-        return sum(1 for _ in self.s3_bucket.objects.all())
+        # objects are counted by LIST once per refresh_interval, in between the count is kept in memory.
+        # so that it notices objects added or deleted by other processes sharing the bucket only after the next LIST.
+        with self._lock:
+            self._load_index_if_stale()
+            return len(self._mtime)
 
     def clear(self):
         self.s3_bucket.objects.all().delete()
+        self._mem.clear()
+        if self._disk is not None:
+            self._disk.clear() # only this bucket's directory
+        self._touched.clear()
+        with self._lock:
+            self._mtime, self._heap, self._loaded = {}, [], monotonic()
+            self._pending.clear()
+        self._negative.clear()
 
     def popitem(self, last=True):
         # https://docs.python.org/3/library/collections.html#collections.OrderedDict.popitem
         # LIFO order if last is true or FIFO order if false
-        # https://stackoverflow.com/a/45379754
-        target_func = max if last else min # no need to use 'sorted'
-        target = target_func(self.s3_bucket.objects.all(), key=attrgetter('last_modified'), default=None) # find the oldest or latest object
-        if target is None:
-            raise KeyError('popitem(): dictionary is empty')
-        else:
-            target.delete()
-            return target.key, None # None is dummy because self[key] takes too much cost
+        # objects are listed once per refresh_interval, in between 'last_modified' is tracked in memory.
+        with self._lock:
+            self._load_index_if_stale()
+            key = self._find_target(last)
+            if key is None:
+                self._load_index() # other processes may have added objects
+                key = self._find_target(last)
+            if key is None:
+                raise KeyError('popitem(): dictionary is empty')
+            del self._mtime[key]
+            self._pending[key] = None
+            if len(self._pending) >= self.delete_batch_size:
+                self.flush()
+        self._forget(key)
+        return key, None # None is dummy because self[key] takes too much cost
+
+    def flush(self):
+        with self._lock:
+            _flush(self.s3_bucket, self._pending)
 
     # set cache TTL
     def set_expiration(self, days=None):
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+import json
+import math
+import os
+import pickle
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from enum import Enum, IntEnum
+from time import time
+
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+from botocore.exceptions import ClientError
+from s3_memoize.s3_memoize import s3_fifo_cache, s3_lru_cache, _S3Dict, _json_dumps, _json_loads
+
+
+BUCKET_NAME = 'test-bucket'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET_NAME)
+        yield client
+
+
+@pytest.mark.parametrize('s3_cache', [s3_fifo_cache, s3_lru_cache])
+def test_hits_and_misses(s3, s3_cache):
+    @s3_cache(maxsize=3, bucket_name=BUCKET_NAME)
+    def f(x):
+        return x * 2
+    assert [f(1), f(1), f(2), f(3)] == [2, 2, 4, 6]
+    assert f.cache_info() == (1, 3, 3, 3)
+
+
+def test_mem_maxsize_is_independent_of_maxsize(s3):
+    cache = _S3Dict(BUCKET_NAME, mem_maxsize=3)
+    for i in range(10):
+        cache[str(i)] = i
+    assert len(cache) == 10
+    assert list(cache._mem) == ['7', '8', '9']
+
+
+def test_every_tier_returns_uploaded_form(s3):
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME)
+    def f(x):
+        return (x, [])
+    result = f(1)
+    result[1].append('mutated')
+    assert f(1) == [1, []] # decoded JSON, not the caller's tuple
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME)
+    def g(x):
+        raise AssertionError
+    assert g(1) == [1, []]
+
+
+def test_popitem_deletes_in_batch(s3):
+    @s3_fifo_cache(maxsize=2, bucket_name=BUCKET_NAME)
+    def f(x):
+        return x
+    for i in range(5):
+        f(i)
+    assert f.cache_info().currsize == 2
+    assert s3.list_objects_v2(Bucket=BUCKET_NAME)['KeyCount'] == 5 # not deleted yet
+    f.cache_flush()
+    assert s3.list_objects_v2(Bucket=BUCKET_NAME)['KeyCount'] == 2
+
+
+def test_concurrent_calls(s3):
+    @s3_fifo_cache(maxsize=4, bucket_name=BUCKET_NAME)
+    def f(x):
+        return x
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        assert list(executor.map(f, range(400))) == list(range(400)) # no exceptions
+    f.cache_flush()
+    assert s3.list_objects_v2(Bucket=BUCKET_NAME)['KeyCount'] == f.cache_info().currsize
+
+
+def test_maxsize_bounds_bucket_shared_by_caches(s3):
+    @s3_fifo_cache(maxsize=5, bucket_name=BUCKET_NAME, refresh_interval=0)
+    def f(x):
+        return x
+    @s3_fifo_cache(maxsize=5, bucket_name=BUCKET_NAME, refresh_interval=0)
+    def g(x):
+        return x
+    for i in range(10):
+        f(('f', i))
+        f.cache_flush() # otherwise the other cache may evict the same pending object again
+        g(('g', i))
+        g.cache_flush()
+    assert s3.list_objects_v2(Bucket=BUCKET_NAME)['KeyCount'] <= 5
+
+
+def test_get_many_returns_default_if_deleted_by_others(s3):
+    @s3_lru_cache(maxsize=None, bucket_name=BUCKET_NAME, touch_interval=0)
+    def f(x):
+        return x
+    assert [f(1), f(2)] == [1, 2]
+    assert f.cache_get_many([(1,), (2,)]) == [1, 2]
+    for obj in s3.list_objects_v2(Bucket=BUCKET_NAME)['Contents']:
+        s3.delete_object(Bucket=BUCKET_NAME, Key=obj['Key'])
+    assert f.cache_get_many([(1,), (2,), (3,)], default='miss') == ['miss', 'miss', 'miss']
+    assert f.cache_info().currsize == 0
+
+
+def test_set_many_stores_others_on_error(s3):
+    cache = _S3Dict(BUCKET_NAME)
+    assert len(cache) == 0
+    with pytest.raises(TypeError):
+        cache.set_many({'a': 1, 'b': object(), 'c': 3})
+    assert len(cache) == 2
+    assert _S3Dict(BUCKET_NAME).get('c') == 3
+
+
+def test_negative_cache(s3):
+    cache = _S3Dict(BUCKET_NAME)
+    gets = []
+    cache.s3_bucket.meta.client.meta.events.register('before-call.s3.GetObject', lambda **kwargs: gets.append(1))
+    assert cache.get('a') is None
+    assert cache.get('a') is None
+    assert len(gets) == 1 # no second GET within negative_ttl
+    cache['a'] = 1
+    assert 'a' not in cache._negative
+    assert cache.get('a') == 1
+
+
+def test_negative_cache_ignores_other_errors(s3, monkeypatch):
+    cache = _S3Dict(BUCKET_NAME)
+    calls = []
+    def fetch(key):
+        calls.append(key)
+        raise ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObject')
+    monkeypatch.setattr(cache, '_fetch', fetch)
+    assert cache.get('a') is None
+    assert cache.get('a') is None
+    assert len(calls) == 2
+
+
+def test_local_cache_is_per_bucket(s3, tmp_path):
+    pytest.importorskip('diskcache')
+    s3.create_bucket(Bucket='other-bucket')
+    cache = _S3Dict(BUCKET_NAME, local_cache_dir=str(tmp_path), local_cache_expire=60)
+    other = _S3Dict('other-bucket', local_cache_dir=str(tmp_path))
+    cache['a'], other['a'] = 1, 2
+    assert (cache._disk['a'], other._disk['a']) == (1, 2)
+    assert 0 < cache._disk.get('a', expire_time=True)[1] - time() <= 60
+    cache.clear()
+    assert 'a' not in cache._disk
+    assert other._disk['a'] == 2
+
+
+def test_cache_is_freed(s3):
+    import gc, weakref
+    cache = _S3Dict(BUCKET_NAME)
+    cache['a'] = 1
+    ref = weakref.ref(cache)
+    del cache
+    gc.collect()
+    assert ref() is None
+
+
+class Color(Enum):
+    RED = 1
+
+
+class Number(IntEnum):
+    ONE = 1
+
+
+@pytest.mark.parametrize('value', [
+    float('nan'), float('inf'), -float('inf'), [1.5, float('nan')], {'a': -float('inf')},
+    2 ** 70, {1: 'a', 'b': (None, True)}, Number.ONE, 'é',
+])
+def test_json_round_trip_matches_json(value):
+    expected = json.loads(json.dumps(value))
+    actual = _json_loads(_json_dumps(value))
+    assert json.dumps(actual) == json.dumps(expected) # NaN != NaN, compare encoded forms
+    assert type(actual) is type(expected)
+
+
+@pytest.mark.parametrize('value', [uuid.UUID(int=1), Color.RED, datetime(2020, 1, 1), [uuid.UUID(int=1)]])
+def test_json_rejects_non_json_types(value):
+    with pytest.raises(TypeError):
+        _json_dumps(value)
+
+
+def test_json_rejects_cyclic_values():
+    cyclic = []
+    cyclic.append(cyclic)
+    with pytest.raises(ValueError):
+        _json_dumps(cyclic)
+
+
+def test_nan_round_trip_through_s3(s3):
+    cache = _S3Dict(BUCKET_NAME)
+    cache['a'] = float('nan')
+    assert math.isnan(_S3Dict(BUCKET_NAME).get('a'))
+
+
+def test_orjson_writes_nan_as_null(s3):
+    pytest.importorskip('orjson')
+    cache = _S3Dict(BUCKET_NAME, serializer='orjson')
+    cache['a'] = [float('nan'), uuid.UUID(int=1)]
+    assert _S3Dict(BUCKET_NAME, serializer='orjson').get('a') == [None, '00000000-0000-0000-0000-000000000001']
+    assert _S3Dict(BUCKET_NAME).get('a') is None # other format
+
+
+class _Exploit:
+    def __reduce__(self):
+        return (_EXPLOITED.append, (True,))
+
+
+_EXPLOITED = []
+
+
+@pytest.mark.parametrize('serializer', ['json', 'msgpack'])
+def test_other_formats_are_misses(s3, serializer):
+    if serializer == 'msgpack':
+        pytest.importorskip('msgpack')
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME, serializer=serializer)
+    def f(x):
+        return 'computed'
+    f(1)
+    key = s3.list_objects_v2(Bucket=BUCKET_NAME)['Contents'][0]['Key']
+    s3.put_object(Bucket=BUCKET_NAME, Key=key, Body=pickle.dumps(_Exploit()), Metadata={'Format': 'pickle'})
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME, serializer=serializer)
+    def g(x):
+        return 'computed'
+    assert g(1) == 'computed'
+    assert g.cache_info().misses == 1
+    assert _EXPLOITED == []
+
+
+@pytest.mark.parametrize('serializer', ['json', 'orjson', 'pickle'])
+def test_serializer_round_trip(s3, serializer):
+    if serializer == 'orjson':
+        pytest.importorskip('orjson')
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME, serializer=serializer)
+    def f(x):
+        return {'x': [x, 'é', 1.5, None, True]}
+    f(1)
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME, serializer=serializer)
+    def g(x):
+        raise AssertionError
+    assert g(1) == {'x': [1, 'é', 1.5, None, True]}
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_compression_round_trip(s3, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME, compression=compression)
+    def f(x):
+        return [x] * 100
+    f(1)
+    key = s3.list_objects_v2(Bucket=BUCKET_NAME)['Contents'][0]['Key']
+    assert s3.head_object(Bucket=BUCKET_NAME, Key=key)['ContentEncoding'] == compression
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME)
+    def g(x):
+        raise AssertionError
+    assert g(1) == [1] * 100
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_large_object_round_trip(s3, compression):
+    # larger than a part (8 MiB) even after compression, so that it is transferred in parts
+    value = os.urandom(12 * 1024 * 1024).hex() if compression else 'x' * (20 * 1024 * 1024 + 1)
+    _S3Dict(BUCKET_NAME, compression=compression)['a'] = value
+    head = s3.head_object(Bucket=BUCKET_NAME, Key='a')
+    assert head['ContentLength'] > 8 * 1024 * 1024
+    assert '-' in head['ETag'] # multipart upload
+    assert _S3Dict(BUCKET_NAME).get('a') == value
+
+
+def test_equal_arguments_share_key(s3):
+    calls = []
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME)
+    def f(x, y):
+        calls.append((x, y))
+        return x + y
+    s = ''.join(['ab', 'c'])
+    assert f(s, s) == f(s, ''.join(['ab', 'c'])) == 'abcabc'
+    assert len(calls) == 1
+    cyclic = []
+    cyclic.append(cyclic)
+    @s3_fifo_cache(maxsize=None, bucket_name=BUCKET_NAME)
+    def g(x):
+        return len(x)
+    assert g(cyclic) == g(cyclic) == 1 # falls back to str()
+    assert g.cache_info().hits == 1